@@ -1,58 +1,149 @@
+import calendar
 import feedparser
+import hashlib
 import logging
 import requests
 import json
 import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import json_utils
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-CACHE_FILE = 'article_cache.json'
+CACHE_DB = 'cache.db'
+LEGACY_CACHE_FILE = 'article_cache.json'
+FETCH_MAX_WORKERS = 16
+# 抓取单个源的连接/读取超时（秒）和最大下载字节数
+FETCH_TIMEOUT = (5, 30)
+FETCH_MAX_BYTES = 5 * 1024 * 1024
+
+# 抓取和验证共享同一个连接池，避免对同一主机重复建立TCP/TLS连接。
+# 订阅源请求一律不重试，也不理会 Retry-After，保证单个源的耗时以请求超时为上限
+_SESSION = requests.Session()
+_retry = Retry(total=0, read=False, respect_retry_after_header=False)
+_SESSION.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=_retry))
+_SESSION.mount('http://', HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=_retry))
+_SESSION.headers.update({'User-Agent': 'MyInfoKekkai/1.0'})
 
-def load_cache():
+def get_cache_connection():
     """
-    从文件加载缓存。
+    打开文章缓存数据库，并在需要时创建表结构。
+
+    首次创建数据库时，会把旧版 article_cache.json 中的条目导入进来。
     """
-    if not os.path.exists(CACHE_FILE):
-        return {}
+    is_new_db = not os.path.exists(CACHE_DB)
+    conn = sqlite3.connect(CACHE_DB)
+    # WAL模式下写入只追加到日志文件，无需改写整个数据库文件
+    conn.execute("PRAGMA journal_mode=WAL")
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS articles(id TEXT PRIMARY KEY, cached_at INTEGER NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_articles_cached_at ON articles(cached_at)")
+        # 旧版数据库没有内容摘要列，按需补上
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(articles)")}
+        if 'content_hash' not in columns:
+            conn.execute("ALTER TABLE articles ADD COLUMN content_hash BLOB")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_articles_content_hash ON articles(content_hash)")
+    if is_new_db and os.path.exists(LEGACY_CACHE_FILE):
+        _import_legacy_cache(conn)
+    return conn
+
+def _import_legacy_cache(conn):
+    """将旧版JSON缓存文件中的条目导入到数据库中。"""
     try:
-        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return {}
+        with open(LEGACY_CACHE_FILE, 'rb') as f:
+            legacy_cache = json_utils.loads(f.read())
+    except (json.JSONDecodeError, OSError):
+        return
+
+    rows = []
+    for key, value in legacy_cache.items():
+        try:
+            rows.append((key, int(datetime.fromisoformat(value['cached_at']).timestamp())))
+        except (TypeError, KeyError, ValueError):
+            # 如果条目格式不正确，则忽略
+            continue
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO articles(id, cached_at) VALUES(?, ?)", rows)
+    logging.info(f"已从 {LEGACY_CACHE_FILE} 导入 {len(rows)} 条缓存记录。")
 
-def save_cache(cache_data):
+def clean_cache(conn, retention_days):
     """
-    将缓存保存到文件。
+    从缓存中移除比指定天数更早的旧条目。
     """
-    with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(cache_data, f, indent=2, ensure_ascii=False)
+    retention_limit = int((datetime.now(timezone.utc) - timedelta(days=retention_days)).timestamp())
+    with conn:
+        conn.execute("DELETE FROM articles WHERE cached_at < ?", (retention_limit,))
 
-def clean_cache(cache_data, retention_days):
+def compact_cache():
     """
-    从缓存中移除比指定天数更早的旧条目。
+    整理缓存数据库：将WAL日志合并回数据库文件，并在空闲页超过一半时回收空间。
+
+    在每次更新流程结束时调用一次，而不是在每次写入时进行。
     """
-    if not cache_data:
-        return cache_data
-    
-    cleaned_cache = {}
-    retention_limit = datetime.now(timezone.utc) - timedelta(days=retention_days)
-    
-    for key, value in cache_data.items():
-        try:
-            # 假设缓存的值是一个包含 'cached_at' 时间戳的字典
-            cached_at = datetime.fromisoformat(value['cached_at'])
-            if cached_at > retention_limit:
-                cleaned_cache[key] = value
-        except (TypeError, KeyError, ValueError):
-            # 如果条目格式不正确，则忽略
-            continue
-            
-    return cleaned_cache
+    if not os.path.exists(CACHE_DB):
+        return
+    conn = get_cache_connection()
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if page_count and freelist_count * 2 > page_count:
+            conn.execute("VACUUM")
+            logging.info(f"缓存数据库已压缩，回收了 {freelist_count} 个空闲页。")
+    finally:
+        conn.close()
+
+def is_cached(conn, article_id) -> bool:
+    """检查文章是否已在缓存中。"""
+    return conn.execute("SELECT 1 FROM articles WHERE id = ?", (article_id,)).fetchone() is not None
+
+def content_hash(title: str, summary: str) -> bytes:
+    """
+    根据规范化后的标题和摘要开头计算内容摘要，用于识别不同源转载的同一篇文章。
+    """
+    norm = title.lower().strip() + '|' + summary[:200].lower()
+    return hashlib.blake2b(norm.encode('utf-8'), digest_size=16).digest()
+
+def is_duplicate_content(conn, digest: bytes) -> bool:
+    """检查缓存中是否已有相同内容的文章。"""
+    return conn.execute("SELECT 1 FROM articles WHERE content_hash = ?", (digest,)).fetchone() is not None
+
+def _download(url: str, max_bytes: int = FETCH_MAX_BYTES):
+    """
+    以流式方式下载RSS源内容，超过大小上限时中止，避免异常巨大的源耗尽内存。
+
+    Returns:
+        (内容字节串, 供feedparser使用的响应头)。响应头中保留最终URL和Content-Type，
+        以便feedparser解析相对链接并识别字符集。
+    """
+    with _SESSION.get(url, stream=True, timeout=FETCH_TIMEOUT) as response:
+        response.raise_for_status()
+        buf = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            buf += chunk
+            if len(buf) > max_bytes:
+                raise ValueError(f"订阅源内容超过 {max_bytes} 字节上限")
+        response_headers = {
+            'content-location': response.url,
+            'content-type': response.headers.get('content-type', ''),
+        }
+        return bytes(buf), response_headers
+
+def _fetch_one(source: dict):
+    """
+    下载并解析单个RSS源，供线程池并发调用。
+    """
+    data, response_headers = _download(source.get('url'))
+    return feedparser.parse(data, response_headers=response_headers)
 
 def fetch_all_feeds(feed_sources: list, priority_max_days: int, interest_max_days: int, cache_retention_days: int) -> list:
     """
-    抓取多个RSS订阅源，合并文章，并根据时效性和缓存进行过滤。
+    抓取多个RSS订阅源，合并文章，并根据时效性和缓存进行过滤，同时去除不同源之间重复的文章。
 
     Args:
         feed_urls: RSS源URL列表。
@@ -63,59 +154,87 @@ def fetch_all_feeds(feed_sources: list, priority_max_days: int, interest_max_day
     Returns:
         一个只包含新的、未被缓存且符合时效的文章的列表。
     """
-    cache = load_cache()
-    cache = clean_cache(cache, cache_retention_days)
+    conn = get_cache_connection()
+    clean_cache(conn, cache_retention_days)
     
     new_articles = []
+    # 本次运行中新发现的文章ID及其内容摘要，抓取结束后一次性写入缓存
+    new_ids = {}
+    # 本次运行中已见过的内容摘要，用于跨源去重
+    seen = set()
     now = datetime.now(timezone.utc)
+    now_epoch = int(now.timestamp())
     max_age_days = max(priority_max_days, interest_max_days)
+    # 预先计算时效截止时间（UTC时间戳），循环内只需做整数比较
+    cutoff_epoch = calendar.timegm((now - timedelta(days=max_age_days)).utctimetuple())
     
     logging.info(f"开始从 {len(feed_sources)} 个源抓取文章，将过滤掉超过 {max_age_days} 天的文章...")
 
-    for source in feed_sources:
-        url = source.get('url')
-        try:
-            feed = feedparser.parse(url)
-            for entry in feed.entries:
-                # 1. 时效性过滤
-                published_time = entry.get('published_parsed')
-                if not published_time:
-                    continue # 跳过没有发布日期的文章
-                
-                # 将feedparser的时间元组转换为带时区的datetime对象
-                pub_date = datetime(*published_time[:6], tzinfo=timezone.utc)
-                
-                if (now - pub_date).days > max_age_days:
-                    continue # 文章太旧，跳过
-
-                # 2. 缓存过滤
-                article_id = entry.get('id', entry.get('link'))
-                if article_id in cache:
-                    continue # 文章已在缓存中，跳过
-
-                # 如果文章是新的且符合时效，则处理并加入列表
-                new_articles.append({
-                    'title': entry.get('title', 'No Title'),
-                    'link': entry.get('link', ''),
-                    'summary': entry.get('summary', ''),
-                    'published': published_time,
-                    'published_iso': pub_date.isoformat() # 保存ISO格式日期
-                })
-                
-                # 将新文章加入缓存
-                cache[article_id] = {'cached_at': now.isoformat()}
-
-        except Exception as e:
-            logging.error(f"抓取源 {url} 时出错: {e}")
+    # 网络请求和解析并发执行；时效性和缓存过滤仍在当前线程中串行进行，数据库连接只在当前线程中使用
+    with ThreadPoolExecutor(max_workers=max(1, min(FETCH_MAX_WORKERS, len(feed_sources)))) as executor:
+        futures = [executor.submit(_fetch_one, source) for source in feed_sources]
+        # 按配置顺序处理结果（下载仍然并发进行），保证多个源转载同一篇文章时保留哪个源的链接是确定的
+        for source, future in zip(feed_sources, futures):
+            url = source.get('url')
+            try:
+                feed = future.result()
+                # 跳过没有发布日期的文章，并按发布时间从新到旧排序，遇到过旧的文章即可停止
+                entries = sorted(
+                    (entry for entry in feed.entries if entry.get('published_parsed')),
+                    key=lambda entry: entry['published_parsed'],
+                    reverse=True
+                )
+                for entry in entries:
+                    # 1. 缓存过滤（稳定运行时绝大多数文章都已缓存，优先做这项最便宜的检查）
+                    article_id = entry.get('id') or entry.get('link')
+                    if article_id in new_ids or is_cached(conn, article_id):
+                        continue # 文章已在缓存中，跳过
+
+                    # 2. 时效性过滤，feedparser的时间元组是UTC时间，直接转换为时间戳比较
+                    published_time = entry['published_parsed']
+                    pub_epoch = calendar.timegm(published_time)
+                    if pub_epoch < cutoff_epoch:
+                        break # 之后的文章只会更旧
+
+                    # 3. 内容去重，不同源转载的同一篇文章链接往往不同
+                    title = entry.get('title', 'No Title')
+                    summary = entry.get('summary', '')
+                    digest = content_hash(title, summary)
+                    if digest in seen or is_duplicate_content(conn, digest):
+                        new_ids[article_id] = digest # 同样记入缓存，下次直接按ID跳过
+                        continue
+                    seen.add(digest)
+
+                    # 如果文章是新的且符合时效，则处理并加入列表
+                    new_articles.append({
+                        'title': title,
+                        'link': entry.get('link', ''),
+                        'summary': summary,
+                        'published': published_time,
+                        'published_iso': datetime.fromtimestamp(pub_epoch, timezone.utc).isoformat() # 保存ISO格式日期
+                    })
+                    
+                    # 将新文章加入缓存
+                    new_ids[article_id] = digest
+
+            except Exception as e:
+                logging.error(f"抓取源 {url} 时出错: {e}")
             
-    save_cache(cache)
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO articles(id, cached_at, content_hash) VALUES(?, ?, ?)",
+                ((article_id, now_epoch, digest) for article_id, digest in new_ids.items())
+            )
+    finally:
+        conn.close()
     logging.info(f"抓取完成，发现 {len(new_articles)} 篇需要处理的新文章。")
     return new_articles
 
 def verify_feed_url(url: str) -> bool:
     """通过尝试请求来验证一个RSS源URL是否有效。"""
     try:
-        response = requests.get(url, headers={'User-Agent': 'MyInfoKekkai/1.0'}, timeout=10)
+        response = _SESSION.get(url, timeout=10)
         response.raise_for_status()
         # 尝试解析以确保是有效的feed格式
         feed = feedparser.parse(response.content)
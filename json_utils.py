@@ -0,0 +1,22 @@
+import json
+
+try:
+    import orjson  # 可选依赖，比标准库json快得多
+except ImportError:
+    orjson = None
+
+def loads(data):
+    """
+    解析JSON字符串或字节串。安装了orjson时使用orjson，否则使用标准库json。
+
+    两种实现在解析失败时都会抛出 json.JSONDecodeError（orjson的异常是其子类）。
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(obj) -> bytes:
+    """将对象序列化为缩进两格、UTF-8编码的JSON字节串。"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
@@ -1,10 +1,123 @@
 import requests
 import logging
 import json
+import re
+import html
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import json_utils
+
+# 每批至少包含的文章数，与按固定10篇分批时的请求次数保持一致
+MIN_CHUNK_SIZE = 10
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def filter_articles_with_llm(articles: list, user_interests: str, priority_keywords: list, api_key: str, api_url: str, model_name: str) -> list:
+# 从LLM的回复中提取JSON对象，兼容包裹在Markdown代码块或说明文字中的情况
+_JSON_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+# 用于在关键词预筛选前去掉摘要中的HTML标签
+_TAG_RE = re.compile(r'<[^>]+>')
+
+# 所有批次共享同一个会话以复用到LLM端点的连接；仅对限流和服务端错误按指数退避重试，
+# 读取超时不重试，以免一次超时的调用被重复发送并重复计费
+_SESSION = requests.Session()
+_retry = Retry(total=3, read=0, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=None)
+_SESSION.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=_retry))
+_SESSION.mount('http://', HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=_retry))
+_SESSION.headers.update({'User-Agent': 'SmartRSS/1.0'})
+
+# 成功加载后的tiktoken编码；加载失败时保持为None，下次调用时重试
+_ENCODING = None
+_encoding_lock = threading.Lock()
+
+def _get_encoding():
+    """
+    首次使用时才加载tiktoken编码。首次加载可能需要下载编码文件，放在导入时会阻塞应用启动。
+
+    只缓存加载成功的结果，一次临时的下载失败不会让进程一直退回到按字符数估算。
+    每次筛选流程开始时调用一次，失败时会在下一次流程中重试。
+    """
+    global _ENCODING
+    if _ENCODING is not None:
+        return _ENCODING
+    with _encoding_lock:
+        if _ENCODING is None:
+            try:
+                import tiktoken
+                _ENCODING = tiktoken.get_encoding('cl100k_base')
+            except Exception:  # 未安装tiktoken或无法加载编码文件时，退回到按字符数估算
+                logging.warning("无法加载tiktoken编码，将按字符数估算token数量。")
+        return _ENCODING
+
+def _count_tokens(text: str, encoding) -> int:
+    """估算文本的token数量。encoding为None时按字符数估算。"""
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # 中文文本大约每个字符一个token，按字符数估算偏保守
+    return len(text)
+
+def _pack_chunks(articles: list, token_budget: int, encoding) -> list:
+    """
+    按token预算将文章贪心地打包成批次，每批的文章token总数不超过预算。
+
+    每批至少包含 MIN_CHUNK_SIZE 篇文章（最后一批除外），即使因此超出预算，
+    以免预算偏小时请求次数反而比固定分批更多。
+    """
+    chunks = []
+    current, current_tokens = [], 0
+    for article in articles:
+        tokens = _count_tokens(f"{article['title']}{article.get('summary', '')[:500]}", encoding)
+        if len(current) >= MIN_CHUNK_SIZE and current_tokens + tokens > token_budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(article)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _keyword_pattern(keyword: str) -> str:
+    """
+    为单个关键词构建正则。以英文字母或数字开头/结尾的一侧要求不与其他英文字母或数字相连，
+    避免 "AI" 命中 "Email"；中文等其他字符仍按子串匹配。
+    """
+    pattern = re.escape(keyword)
+    if keyword[0].isascii() and keyword[0].isalnum():
+        pattern = r'(?<![A-Za-z0-9])' + pattern
+    if keyword[-1].isascii() and keyword[-1].isalnum():
+        pattern += r'(?![A-Za-z0-9])'
+    return pattern
+
+def preselect_by_keywords(articles: list, priority_keywords: list) -> tuple:
+    """
+    用正则快速匹配优先关注关键词，命中的文章直接选中，无需再交给LLM判断。
+
+    Returns:
+        (命中关键词的文章列表, 未命中、仍需LLM筛选的文章列表)
+    """
+    keywords = [kw for kw in priority_keywords if kw]
+    if not keywords:
+        return [], articles
+
+    keyword_re = re.compile('(' + '|'.join(_keyword_pattern(kw) for kw in keywords) + ')', re.IGNORECASE)
+    # 匹配结果可能与配置的大小写不同，统一映射回配置中的关键词
+    canonical = {kw.lower(): kw for kw in keywords}
+    pre_selected, remaining = [], []
+    for article in articles:
+        summary_text = html.unescape(_TAG_RE.sub(' ', article.get('summary', '')))
+        match = keyword_re.search(article['title'] + '\n' + summary_text[:500])
+        if match:
+            article['selection_reason'] = canonical.get(match.group(1).lower(), match.group(1))
+            pre_selected.append(article)
+        else:
+            remaining.append(article)
+    logging.info(f"关键词预筛选命中 {len(pre_selected)} 篇文章，其余 {len(remaining)} 篇交由LLM筛选。")
+    return pre_selected, remaining
+
+def filter_articles_with_llm(articles: list, user_interests: str, priority_keywords: list, api_key: str, api_url: str, model_name: str, concurrency: int = 5, input_token_budget: int = 8000) -> list:
     """
     使用LLM根据用户兴趣筛选文章，支持Gemini和OpenAI兼容的API。
 
@@ -15,6 +128,8 @@ def filter_articles_with_llm(articles: list, user_interests: str, priority_keywo
         api_key: API密钥。
         api_url: LLM API的端点URL。
         model_name: (可选) 用于OpenAI兼容API的模型名称。
+        concurrency: 同时发送给LLM的最大批次数。
+        input_token_budget: 每批请求的输入token预算（含提示词本身）。
 
     Returns:
         一个经过筛选，符合用户兴趣的文章列表。
@@ -29,15 +144,8 @@ def filter_articles_with_llm(articles: list, user_interests: str, priority_keywo
     logging.info(f"检测到API类型: {api_type}")
     
     selected_articles = []
-    chunk_size = 10  # 每次处理10篇文章，防止超出上下文长度
-
-    logging.info(f"开始使用LLM筛选文章，共 {len(articles)} 篇，每批处理 {chunk_size} 篇。")
-
-    for i in range(0, len(articles), chunk_size):
-        chunk = articles[i:i + chunk_size]
-        
-        priority_keywords_str = ", ".join([f'"{kw}"' for kw in priority_keywords])
-        base_prompt = f"""你是一个智能信息分析助手，任务是从文章列表中为我筛选出我应该阅读的内容。请仔细评估每一篇文章，确保不会错过任何重要或我感兴趣的内容。
+    priority_keywords_str = ", ".join(f'"{kw}"' for kw in priority_keywords)
+    base_prompt = f"""你是一个智能信息分析助手，任务是从文章列表中为我筛选出我应该阅读的内容。请仔细评估每一篇文章，确保不会错过任何重要或我感兴趣的内容。
 
 筛选标准分为两级：
 1.  **优先关注**: 任何内容与以下关键词高度相关的文章都必须被选中：[{priority_keywords_str}]。
@@ -61,18 +169,40 @@ def filter_articles_with_llm(articles: list, user_interests: str, priority_keywo
 ```
 
 **待分析的文章列表**:
-        """
-        for idx, article in enumerate(chunk):
-            # 增加摘要长度，为LLM提供更多上下文以做出更准确的判断
-            summary_text = article.get('summary', '')
-            base_prompt += f"\n{idx}. 标题: {article['title']}\n   摘要: {summary_text[:500]}...\n"
+    """
+
+    # 提示词本身占用的token从预算中扣除，剩余部分用于装载文章
+    encoding = _get_encoding()
+    base_overhead = _count_tokens(base_prompt, encoding)
+    if base_overhead >= input_token_budget:
+        logging.warning(f"提示词本身约 {base_overhead} token，已超出输入token预算 {input_token_budget}，"
+                        f"每批将只包含 {MIN_CHUNK_SIZE} 篇文章。请缩短通用兴趣描述或调大 llm_input_token_budget。")
+    chunks = _pack_chunks(articles, max(0, input_token_budget - base_overhead), encoding)
+
+    logging.info(f"开始使用LLM筛选文章，共 {len(articles)} 篇，按token预算分为 {len(chunks)} 批。")
+
+    # 部分OpenAI兼容服务（如本地模型）不支持结构化输出参数，会返回400；
+    # 一旦遇到就去掉该参数重发，并在后续批次中不再携带
+    structured_output = {'enabled': True}
+    structured_output_key = "generationConfig" if api_type == "gemini" else "response_format"
+
+    def _process_chunk(batch_no, chunk):
+        chunk_selected = []
+        # 提示词的静态部分只构建一次，每批只拼接文章列表
+        # 增加摘要长度，为LLM提供更多上下文以做出更准确的判断
+        chunk_articles_str = ''.join(
+            f"\n{idx}. 标题: {article['title']}\n   摘要: {article.get('summary', '')[:500]}...\n"
+            for idx, article in enumerate(chunk)
+        )
+        prompt = base_prompt + chunk_articles_str
 
-        prompt = base_prompt
         # 根据API类型构建不同的prompt和payload
         if api_type == "gemini":
             full_api_url = f"{api_url}?key={api_key}"
             headers = {"Content-Type": "application/json"}
             payload = {"contents": [{"parts": [{"text": prompt}]}]}
+            if structured_output['enabled']:
+                payload["generationConfig"] = {"response_mime_type": "application/json"}
         else:  # openai compatible
             full_api_url = api_url
             headers = {
@@ -83,15 +213,23 @@ def filter_articles_with_llm(articles: list, user_interests: str, priority_keywo
                 "model": model_name,  # 对于本地模型或兼容API，此名称可能是必需的
                 "messages": [{"role": "user", "content": prompt}],
             }
+            if structured_output['enabled']:
+                payload["response_format"] = {"type": "json_object"}
 
+        # 在try之前初始化，保证任何异常处理分支都能安全地引用它，单个批次的错误不会影响其他批次
+        response_text = ""
         try:
-            logging.info(f"正在处理第 {i//chunk_size + 1} 批文章 (API: {api_type})...")
+            logging.info(f"正在处理第 {batch_no} 批文章 (API: {api_type})...")
             
-            response = requests.post(full_api_url, headers=headers, json=payload, timeout=60)
+            response = _SESSION.post(full_api_url, headers=headers, json=payload, timeout=60)
+            if response.status_code == 400 and structured_output_key in payload:
+                logging.warning(f"LLM API不支持 {structured_output_key} 参数，去掉该参数后重试。")
+                structured_output['enabled'] = False
+                del payload[structured_output_key]
+                response = _SESSION.post(full_api_url, headers=headers, json=payload, timeout=60)
             response.raise_for_status()  # 如果请求失败 (状态码 4xx or 5xx), 则会抛出异常
             
             response_data = response.json()
-            response_text = ""
 
             # 根据API类型解析响应
             if api_type == "gemini":
@@ -99,28 +237,20 @@ def filter_articles_with_llm(articles: list, user_interests: str, priority_keywo
                     response_text = response_data['candidates'][0]['content']['parts'][0]['text']
                 else:
                     logging.error(f"Gemini响应格式不完整或为空: {response_data}")
-                    continue
+                    return chunk_selected
             else: # openai
                 if response_data.get('choices') and response_data['choices'][0].get('message', {}).get('content'):
                     response_text = response_data['choices'][0]['message']['content']
                 else:
                     logging.error(f"OpenAI响应格式不完整或为空: {response_data}")
-                    continue
+                    return chunk_selected
             
-            # 清理并解析LLM返回的JSON
-            cleaned_text = response_text.strip()
-            # 从Markdown代码块中提取JSON
-            if cleaned_text.startswith("```json"):
-                cleaned_text = cleaned_text[7:].strip()
-            elif cleaned_text.startswith("```"):
-                cleaned_text = cleaned_text[3:].strip()
-            if cleaned_text.endswith("```"):
-                cleaned_text = cleaned_text[:-3].strip()
-            if cleaned_text.startswith("json"):
-                cleaned_text = cleaned_text[4:].strip()
-
-            # 根据API类型解析JSON内容
-            json_data = json.loads(cleaned_text)
+            # 提取并解析LLM返回的JSON
+            match = _JSON_RE.search(response_text)
+            if not match:
+                logging.error(f"LLM的响应中未找到JSON对象: {response_text}")
+                return chunk_selected
+            json_data = json_utils.loads(match.group(0))
             selections = json_data.get("selected_articles", [])
             
             logging.info(f"LLM返回的筛选结果: {selections}")
@@ -131,13 +261,19 @@ def filter_articles_with_llm(articles: list, user_interests: str, priority_keywo
                 if isinstance(index, int) and 0 <= index < len(chunk) and reason:
                     selected_article = chunk[index]
                     selected_article['selection_reason'] = reason
-                    selected_articles.append(selected_article)
+                    chunk_selected.append(selected_article)
         except json.JSONDecodeError:
             logging.error(f"无法解析LLM的响应为JSON: {response_text}")
         except requests.exceptions.RequestException as e:
             logging.error(f"请求LLM API时出错: {e}")
         except Exception as e:
-            logging.error(f"处理第 {i//chunk_size + 1} 批文章时发生未知错误: {e}")
+            logging.error(f"处理第 {batch_no} 批文章时发生未知错误: {e}")
+        return chunk_selected
+
+    pairs = list(enumerate(chunks, start=1))
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for chunk_selected in executor.map(lambda pair: _process_chunk(*pair), pairs):
+            selected_articles.extend(chunk_selected)
 
     logging.info(f"筛选完成，共选出 {len(selected_articles)} 篇感兴趣的文章。")
     return selected_articles
\ No newline at end of file
@@ -1,10 +1,10 @@
 import os
-import json
 
 import logging
 import threading, os
-from functools import wraps
-from flask import Flask, send_from_directory, request, render_template, redirect, url_for, flash, Response, session
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, lru_cache
+from flask import Flask, send_from_directory, request, render_template, redirect, url_for, flash, Response, session, jsonify
 from dotenv import load_dotenv, set_key, find_dotenv
 from flask_wtf import FlaskForm
 from wtforms import PasswordField
@@ -12,15 +12,25 @@ from wtforms.validators import DataRequired
 from werkzeug.security import check_password_hash, generate_password_hash
 import feedparser
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerThreadPoolExecutor
 from time import strftime
 
+import json_utils
 from feed_fetcher import verify_feed_url
 from feed_fetcher import fetch_all_feeds
-from llm_processor import filter_articles_with_llm
+from feed_fetcher import compact_cache
+from feed_fetcher import CACHE_DB, LEGACY_CACHE_FILE
+from llm_processor import filter_articles_with_llm, preselect_by_keywords
 from rss_generator import create_rss_feed
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-scheduler = BackgroundScheduler(daemon=True)
+# 单线程执行器 + coalesce：长时间停机后错过的多次运行只会合并执行一次，且同一任务不会重叠运行
+scheduler = BackgroundScheduler(
+    daemon=True,
+    executors={'default': SchedulerThreadPoolExecutor(max_workers=1)},
+    job_defaults={'coalesce': True, 'max_instances': 1}
+)
+scheduler.last_interval = None
 # 加载环境变量 (GEMINI_API_KEY)
 load_dotenv()
 
@@ -55,18 +65,17 @@ def login_required(f):
 @login_required
 def verify_feeds_route():
     """处理一键检查所有RSS源的请求。"""
-    urls = request.json.get('urls', [])
-    results = {}
-    for url in urls:
-        if not url:
-            continue
-        is_valid = verify_feed_url(url)
-        results[url] = is_valid
+    urls = [url for url in request.json.get('urls', []) if url]
+    # 并发验证，总耗时取决于最慢的那个源，而不是所有源耗时之和
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        results = dict(zip(urls, executor.map(verify_feed_url, urls)))
+    for url, is_valid in results.items():
         status = "有效" if is_valid else "失效"
         logging.info(f"验证URL: {url} -> {status}")
-    return json.dumps(results)
+    return jsonify(results)
 
-# 用于防止重复更新的全局锁
+# 用于防止重复更新的全局锁。调度器本身保证定时任务不会重叠，
+# 但“立即更新”和保存设置会在调度器之外直接启动线程，仍需要这把锁
 update_in_progress = threading.Lock()
 
 # --- 表单定义 ---
@@ -86,11 +95,21 @@ class ClearCacheForm(FlaskForm):
     pass
 
 
+# config.json 的进程内缓存，以文件修改时间判断是否需要重新加载
+_CONFIG_CACHE = {'mtime': None, 'data': None}
+_config_lock = threading.Lock()
+
 def load_config():
-    """从config.json加载配置"""
+    """从config.json加载配置，文件未变化时直接返回缓存的结果"""
     try:
-        with open('config.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with _config_lock:
+            mtime = os.stat('config.json').st_mtime_ns
+            if _CONFIG_CACHE['mtime'] != mtime:
+                with open('config.json', 'rb') as f:
+                    _CONFIG_CACHE['data'] = json_utils.loads(f.read())
+                _CONFIG_CACHE['mtime'] = mtime
+            # 返回浅拷贝：调用方只会整体替换顶层键，不会原地修改嵌套的值
+            return dict(_CONFIG_CACHE['data'])
     except FileNotFoundError:
         # 如果配置文件不存在，返回一个默认结构以避免错误
         logging.warning("config.json not found. Using default structure.")
@@ -100,6 +119,8 @@ def load_config():
             "priority_keywords": [],
             "llm_api_endpoint": "",
             "llm_model_name": "local-model",
+            "llm_concurrency": 5,
+            "llm_input_token_budget": 8000,
             "output_file": "smart_rss.xml",
             "server_port": 8000,
             "update_interval_hours": 1,
@@ -115,8 +136,19 @@ def load_config():
 
 def save_config(config_data):
     """将配置数据写入config.json文件"""
-    with open('config.json', 'w', encoding='utf-8') as f:
-        json.dump(config_data, f, indent=2, ensure_ascii=False)
+    with _config_lock:
+        with open('config.json', 'wb') as f:
+            f.write(json_utils.dumps(config_data))
+        _CONFIG_CACHE['mtime'] = None
+
+@lru_cache(maxsize=4)
+def _parse_feed_cached(path, mtime):
+    """解析RSS文件。以文件修改时间作为缓存键的一部分，文件被重新生成后自动失效。"""
+    return list(feedparser.parse(path).entries)
+
+def load_feed_entries(output_file):
+    """返回已生成RSS文件的条目，文件未变化时直接返回缓存的结果"""
+    return _parse_feed_cached(output_file, os.stat(output_file).st_mtime_ns)
 
 def run_update_process():
     """执行完整的更新流程"""
@@ -149,13 +181,21 @@ def run_update_process():
             cache_retention_days=config.get('cache_retention_days', 30)
         )
 
-        # 2. 使用LLM筛选
-        selected_articles = filter_articles_with_llm(new_articles, config['user_interests'], config.get('priority_keywords', []), api_key, api_url, model_name)
+        # 2. 命中优先关注关键词的文章直接选中，其余文章使用LLM筛选
+        priority_keywords = config.get('priority_keywords', [])
+        pre_selected, remaining_articles = preselect_by_keywords(new_articles, priority_keywords)
+        selected_articles = pre_selected + filter_articles_with_llm(remaining_articles, config['user_interests'], priority_keywords, api_key, api_url, model_name,
+                                                                    concurrency=config.get('llm_concurrency', 5),
+                                                                    input_token_budget=config.get('llm_input_token_budget', 8000))
 
         # 3. 生成新的RSS文件
         create_rss_feed(selected_articles, config['output_file'], config.get('output_feed_details', {}))
         logging.info(f"流程完成！新的RSS文件已生成在 {config['output_file']}")
     finally:
+        try:
+            compact_cache()
+        except Exception as e:
+            logging.error(f"整理缓存数据库时出错: {e}")
         update_in_progress.release()
 
 @app.route('/')
@@ -171,8 +211,7 @@ def index():
 
     if feed_exists:
         # 解析已生成的RSS文件以获取内容
-        feed = feedparser.parse(output_file)
-        articles = feed.entries
+        articles = load_feed_entries(output_file)
 
     return render_template('index.html', feed_url=feed_url, feed_exists=feed_exists, articles=articles)
 
@@ -183,7 +222,15 @@ def serve_rss_feed():
     output_file = config.get('output_file', 'smart_rss.xml')
     if not os.path.exists(output_file):
         return "订阅源尚未生成。请访问主页，登录并完成设置。", 404
-    return send_from_directory('.', output_file, mimetype='application/rss+xml')
+    # 客户端支持gzip且预压缩文件不旧于原文件时，直接返回预压缩的版本
+    gz_file = output_file + '.gz'
+    if request.accept_encodings['gzip'] and os.path.exists(gz_file) and os.path.getmtime(gz_file) >= os.path.getmtime(output_file):
+        response = send_from_directory('.', gz_file, mimetype='application/rss+xml', max_age=600)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_from_directory('.', output_file, mimetype='application/rss+xml', max_age=600)
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 @app.route('/settings', methods=['GET', 'POST'])
@@ -286,12 +333,13 @@ def clear_cache():
         flash('无效的请求或CSRF令牌已过期。', 'error')
         return redirect(url_for('settings'))
 
-    cache_file = 'article_cache.json'
-    if os.path.exists(cache_file):
+    cache_files = [f for f in (CACHE_DB, f"{CACHE_DB}-wal", f"{CACHE_DB}-shm", LEGACY_CACHE_FILE) if os.path.exists(f)]
+    if cache_files:
         try:
-            os.remove(cache_file)
+            for cache_file in cache_files:
+                os.remove(cache_file)
             flash('文章缓存已成功清除！下次更新时将重新处理所有文章。', 'success')
-            logging.info("Article cache file 'article_cache.json' was manually cleared.")
+            logging.info(f"Article cache files {cache_files} were manually cleared.")
         except OSError as e:
             flash(f'清除缓存时出错: {e}', 'error')
             logging.error(f"Error clearing cache file {cache_file}: {e}")
@@ -300,7 +348,9 @@ def clear_cache():
     return redirect(url_for('settings'))
 
 def reschedule_update_task(hours):
-    """重新安排后台更新任务。"""
+    """重新安排后台更新任务，时间间隔未变化时不做任何操作。"""
+    if scheduler.last_interval == hours:
+        return
     # 使用 add_job 并设置 replace_existing=True，这是更健壮的方式。
     # 它会替换现有任务，或者如果任务不存在则创建它，从而避免 JobLookupError。
     scheduler.add_job(
@@ -310,6 +360,7 @@ def reschedule_update_task(hours):
         id='daily_update',
         replace_existing=True
     )
+    scheduler.last_interval = hours
     logging.info(f"自动更新任务已重新调度，频率为每 {hours} 小时一次。")
 
 if __name__ == '__main__':
@@ -324,6 +375,7 @@ if __name__ == '__main__':
         hours=update_interval, 
         id='daily_update'
     )
+    scheduler.last_interval = update_interval
     scheduler.start()
     logging.info(f"服务启动，自动更新已设置为每 {update_interval} 小时运行一次。")
 
@@ -1,38 +1,52 @@
-from feedgen.feed import FeedGenerator
-from datetime import datetime
-import pytz
+import gzip
+import os
+import shutil
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from email.utils import format_datetime
 
 def create_rss_feed(articles: list, output_path: str, feed_config: dict):
     """
-    根据文章列表创建一个RSS文件。
+    根据文章列表创建一个RSS文件，并在旁边生成一份预压缩的 .gz 副本供支持gzip的客户端使用。
 
     Args:
         articles: 包含筛选后文章的字典列表。
         output_path: 生成的RSS文件的保存路径。
         feed_config: 包含RSS feed元数据（如标题、链接、描述）的字典。
     """
-    fg = FeedGenerator()
-    fg.title(feed_config.get('title', 'Personalized AI RSS Feed'))
-    fg.link(href=feed_config.get('link', 'http://localhost'), rel='alternate')
-    fg.description(feed_config.get('description', 'Articles filtered by AI based on my interests.'))
-    fg.language('zh-CN')
+    rss = ET.Element('rss', version='2.0')
+    channel = ET.SubElement(rss, 'channel')
+    ET.SubElement(channel, 'title').text = feed_config.get('title', 'Personalized AI RSS Feed')
+    ET.SubElement(channel, 'link').text = feed_config.get('link', 'http://localhost')
+    ET.SubElement(channel, 'description').text = feed_config.get('description', 'Articles filtered by AI based on my interests.')
+    ET.SubElement(channel, 'language').text = 'zh-CN'
+    ET.SubElement(channel, 'lastBuildDate').text = format_datetime(datetime.now(timezone.utc))
 
-    for article in articles:
-        fe = fg.add_entry()
+    # 与之前feedgen的默认行为保持一致：后加入的文章排在前面
+    for article in reversed(articles):
+        item = ET.SubElement(channel, 'item')
 
         title = article['title']
         reason = article.get('selection_reason')
         # 如果文章是因优先关注而被选中，则在标题前添加标记
         if reason and reason != 'interest':
             title = f"[{reason}] {title}"
-        fe.title(title)
-        fe.link(href=article['link'])
-        fe.description(article['summary'])
-        
-        # 处理发布日期
+        ET.SubElement(item, 'title').text = title
+        ET.SubElement(item, 'link').text = article['link']
+        ET.SubElement(item, 'description').text = article['summary']
+
+        # 处理发布日期，RSS要求RFC 822格式
         if article['published']:
-            # feedgen需要时区信息的datetime对象
-            pub_date = datetime(*article['published'][:6])
-            fe.pubDate(pytz.UTC.localize(pub_date))
+            pub_date = datetime(*article['published'][:6], tzinfo=timezone.utc)
+            ET.SubElement(item, 'pubDate').text = format_datetime(pub_date)
+
+    # XML和 .gz 都先写入临时文件再原子替换，避免正在提供服务或被解析的文件只写了一半
+    tmp_path = output_path + '.tmp'
+    ET.ElementTree(rss).write(tmp_path, encoding='utf-8', xml_declaration=True)
+    os.replace(tmp_path, output_path)
 
-    fg.rss_file(output_path, pretty=True)
\ No newline at end of file
+    gz_path = output_path + '.gz'
+    gz_tmp_path = gz_path + '.tmp'
+    with open(output_path, 'rb') as src, gzip.open(gz_tmp_path, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(gz_tmp_path, gz_path)